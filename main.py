@@ -1,22 +1,69 @@
 #!/usr/bin/env python3.7
 # -*- coding: utf-8 -*-
 
-from simplecloud import cloud, logger
 from cmd import Cmd
 
 import os
 import sys
 from threading import Thread
-import webbrowser
 import json
-import argparse
-import shlex
+import orjson
+import fastjsonschema
+import functools
+import re
 from inspect import cleandoc
-from collections import defaultdict
-import traceback
 import signal
 
 
+_CONFIG_SCHEMA = {
+    "type": "object",
+    "required": ["subnet"],
+    "properties": {
+        "subnet": {"type": "string"},
+        "network_name": {"type": "string"},
+        "ovs": {"type": ["boolean", "string"]},
+        "proxy_ip": {"type": "string"},
+        "gateway_ip": {"type": "string"},
+        "entrypoint": {"type": "string"},
+        "initial_services": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "required": ["image", "name", "port"],
+                "properties": {
+                    "image": {"type": "string"},
+                    "name": {"type": "string"},
+                    "port": {"type": "integer"},
+                    "scale": {"type": "integer"},
+                    "command": {"type": ["string", "null"]}
+                }
+            }
+        }
+    }
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _config_validator():
+    """Compiles the config schema once, validating is then a plain function call"""
+    return fastjsonschema.compile(_CONFIG_SCHEMA)
+
+
+# a token is a run of non-whitespace characters and quoted strings
+_TOKEN_RE = re.compile(r'''(?:"[^"]*"|'[^']*'|[^\s"'])+''')
+_QUOTED_RE = re.compile(r'"([^"]*)"|\'([^\']*)\'')
+
+
+def _unquote(match):
+    return match.group(1) if match.group(1) is not None else match.group(2)
+
+
+def _fast_split(line):
+    """Splits a command line into tokens, quotes are handled like shlex.split"""
+    return [_QUOTED_RE.sub(_unquote, token) if '"' in token or "'" in token else token
+            for token in _TOKEN_RE.findall(line)]
+
+
 def _parse_int(token, default=0):
     """Returns an integer from a string token.
     Returns the default value if the token cannot be converted to int"""
@@ -39,11 +86,11 @@ def _parse_args(argv):
 
     If more than one arguments with the same name is used, the last value will be used
     """
-    values = defaultdict(str)
+    values = {}
     new_argv = []
     for token in argv:
-        if token[:2] == "--":
-            arg, val = token[2:].split("=", 1)
+        if token.startswith("--"):
+            arg, _, val = token[2:].partition("=")
             values[arg] = val
         else:
             new_argv.append(token)
@@ -62,6 +109,19 @@ class CloudShell(Cmd, object):
         self.cloud = cloud_obj
         self.prompt = "(%s) >> " % self.cloud.proxy_ip
 
+        # bound do_* methods by command name, skips the getattr in Cmd.onecmd
+        self._dispatch = {
+            name[3:]: getattr(self, name)
+            for name in self.get_names() if name[:3] == "do_"
+        }
+
+        # commands and their one-line summaries never change, list them once
+        self._help_table = [
+            (name[3:], (getattr(self, name).__doc__ or "").split("\n")[0])
+            for name in self.get_names() if name[:3] == "do_"
+        ]
+        self._help_col_width = max(len(cmd) for cmd, _ in self._help_table) + 4
+
     def cmdloop(self, intro=None):
         """Override Cmd.cmdloop to add handler for SIGINT
         Repeatedly issue a prompt, accept input, parse an initial prefix
@@ -71,7 +131,9 @@ class CloudShell(Cmd, object):
         os.system("clear")
 
         self.preloop()
-        if self.use_rawinput and self.completekey:
+        # completion is only useful to a person typing, skip readline for scripts
+        use_readline = self.use_rawinput and self.completekey and sys.stdin.isatty()
+        if use_readline:
             try:
                 import readline
                 self.old_completer = readline.get_completer()
@@ -113,15 +175,31 @@ class CloudShell(Cmd, object):
                     continue
             self.postloop()
         finally:
-            if self.use_rawinput and self.completekey:
+            if use_readline:
                 try:
                     import readline
                     readline.set_completer(self.old_completer)
                 except ImportError:
                     pass
 
+    def onecmd(self, line):
+        """Override Cmd.onecmd to dispatch through the precomputed command table"""
+        cmd, arg, line = self.parseline(line)
+        if not line:
+            return self.emptyline()
+        if cmd is None:
+            return self.default(line)
+        self.lastcmd = line
+        if line == 'EOF':
+            self.lastcmd = ''
+        try:
+            func = self._dispatch[cmd]
+        except KeyError:
+            return self.default(line)
+        return func(arg)
+
     def _parse_start(self, line):
-        argv = shlex.split(line)
+        argv = _fast_split(line)
         if len(argv) < 3:
             self.stdout.write("Usage: start IMAGE SERVICE_NAME PORT "
                               "[--scale=INITIAL_SCALE] [--command=COMMAND]\n")
@@ -131,8 +209,8 @@ class CloudShell(Cmd, object):
             "image": argv[0],
             "name": argv[1],
             "port": _parse_int(argv[2], 80),
-            "scale": _parse_int(_kwargs["scale"], 1),
-            "command": _kwargs["command"]
+            "scale": _parse_int(_kwargs.get("scale", ""), 1),
+            "command": _kwargs.get("command")
         }
 
         return _parsed
@@ -154,7 +232,7 @@ class CloudShell(Cmd, object):
                 return
 
     def _parse_stop(self, line):
-        argv = shlex.split(line)
+        argv = _fast_split(line)
         if len(argv) == 0:
             self.stdout.write("Usage: stop SERVICE_NAME\n")
             return None
@@ -173,7 +251,7 @@ class CloudShell(Cmd, object):
             self.cloud.stop_service(_kwargs["name"])
 
     def _parse_show(self, line):
-        argv = shlex.split(line)
+        argv = _fast_split(line)
         if len(argv) == 0:
             self.stdout.write("Usage: show SERVICE_NAME\n")
             return None
@@ -193,8 +271,7 @@ class CloudShell(Cmd, object):
             if not _info:
                 self.stdout.write("Can't retrieve service information\n")
             else:
-                self.stdout.write(json.dumps(_info, indent=2))
-                self.stdout.write("\n")
+                self.stdout.write(json.dumps(_info, indent=2) + "\n")
 
     def do_list(self, line):
         """List all running services
@@ -204,7 +281,7 @@ class CloudShell(Cmd, object):
         self.stdout.write("\n".join(services) + "\n")
 
     def _parse_scale(self, line):
-        argv = shlex.split(line)
+        argv = _fast_split(line)
         if len(argv) < 2:
             self.stdout.write("Usage: scale SERVICE_NAME SIZE")
             return None
@@ -215,7 +292,7 @@ class CloudShell(Cmd, object):
         return _kwargs
 
     def complete_scale(self, text, *ignored):
-        argv = shlex.split(text)
+        argv = _fast_split(text)
         if len(argv) <= 1:
             _services = self.cloud.list_services()
             return [name for name in _services if name.startswith(text)]
@@ -231,7 +308,7 @@ class CloudShell(Cmd, object):
             self.cloud.scale_service(_kwargs["name"], _kwargs["size"])
 
     def _parse_config(self, line):
-        argv = shlex.split(line)
+        argv = _fast_split(line)
         if len(argv) < 3:
             self.stdout.write("Usage: config SERVICE_NAME KEY VALUE [--action=<delete|put>]")
             return None
@@ -248,18 +325,20 @@ class CloudShell(Cmd, object):
         return _kwargs
 
     def complete_config(self, text, line, *ignored):
-        argv = shlex.split(line)
+        argv = _fast_split(line)
         if (len(argv) == 1 and not text) \
                 or (len(argv) == 2 and text):
             _services = self.cloud.list_services()
             return [name for name in _services if name.startswith(text)]
         elif (len(argv) == 2 and not text) \
                 or (len(argv) == 3 and text):
-            _keys = cloud.proxy_configs.keys()
+            from simplecloud.cloud import proxy_configs
+            _keys = proxy_configs.keys()
             return [k for k in _keys if k.startswith(text)]
         elif (len(argv) == 3 and not text) \
                 or (len(argv) == 4 and text):
-            _values = cloud.proxy_configs.get(argv[2], [])
+            from simplecloud.cloud import proxy_configs
+            _values = proxy_configs.get(argv[2], [])
             return [v for v in _values if v.startswith(text)]
 
     def do_config(self, line):
@@ -282,6 +361,8 @@ class CloudShell(Cmd, object):
         """Show statistics in a web browser
 
         Usage: stats"""
+        import webbrowser
+
         url = 'http://%s:10000/stats' % self.cloud.proxy_ip
         webbrowser.open(url)
 
@@ -307,45 +388,51 @@ class CloudShell(Cmd, object):
                     self.stdout.write("%s\n" % cleandoc(doc))
                     return
             except AttributeError:
-                self.stdout.write("%s\n", str(self.nohelp % (line,)))
+                self.stdout.write("%s\n" % str(self.nohelp % (line,)))
         else:
-            cmds = {}
-            for name in self.get_names():
-                if name[:3] == "do_":
-                    cmd = name[3:]
-                    cmds[cmd] = getattr(self, name).__doc__
-            self.stdout.write("Interactive shell to manage simple cloud services\n\n")
-            self.stdout.write("List of available commands:\n")
-            # Calculate padding length
-            col_width = max([len(word) for word in cmds.keys()]) + 4
-            for key, value in cmds.items():
-                self.stdout.write("\t%s%s\n" %
-                                  (key.ljust(col_width), value.split("\n")[0]))
+            col_width = self._help_col_width
+            self.stdout.write(
+                "Interactive shell to manage simple cloud services\n\n"
+                "List of available commands:\n" +
+                "".join("\t%s%s\n" % (cmd.ljust(col_width), summary)
+                        for cmd, summary in self._help_table))
 
 
 class KeyNotFoundError(Exception):
     pass
 
 
-def parse_file(config_path):
+def parse_file(config_path, verbose=False):
+    from simplecloud import logger
+
     if not os.path.isfile(config_path):
         raise IOError
-    with open(config_path, "r") as f:
+    with open(config_path, "rb") as f:
         try:
-            configs = json.load(f, encoding="utf-8")
+            configs = orjson.loads(f.read())
         except ValueError:
             raise ValueError("Configuration file is not in JSON format")
 
-    # config file must contain subnet range
-    if "subnet" not in configs:
-        raise KeyNotFoundError("You need to specify the subnet range")
+    try:
+        _config_validator()(configs)
+    except fastjsonschema.JsonSchemaException as e:
+        # config file must contain subnet range
+        if "subnet" not in configs:
+            raise KeyNotFoundError("You need to specify the subnet range")
+        raise ValueError("Invalid configuration: %s" % e.message)
 
-    logger.info(json.dumps(configs, indent=2, sort_keys=True))
+    if verbose:
+        logger.info(orjson.dumps(
+            configs, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS).decode())
 
     return configs
 
 
-if __name__ == "__main__":
+@functools.lru_cache(maxsize=1)
+def get_args():
+    """Parses the command line arguments, the result is cached after the first call"""
+    import argparse
+
     parser = argparse.ArgumentParser(
         description="Simple cloud program with a TCP proxy, "
                     "service registry and auto-discovery."
@@ -376,10 +463,20 @@ if __name__ == "__main__":
     validate_group.add_argument("--no-validate-ip", dest="validate", action="store_false",
                                 help="Skip validation of configurations")
 
-    parsed = parser.parse_args()
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print the parsed configurations")
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    parsed = get_args()
+
+    # importing simplecloud pulls in docker-py, skip it for --help
+    from simplecloud import cloud, logger
 
     if parsed.config:
-        kwargs = parse_file(parsed.config)
+        kwargs = parse_file(parsed.config, parsed.verbose)
     else:
         kwargs = vars(parsed)
 
@@ -406,10 +503,8 @@ if __name__ == "__main__":
 
         cloud_shell.cmdloop()
 
-    except Exception as e:
-        logger.error(''.join(
-                traceback.format_exception(
-                    type(e), e, e.__traceback__)))
+    except Exception:
+        logger.exception("Cloud shell stopped on error")
     finally:
         if my_cloud and my_cloud.running:
             my_cloud.cleanup()
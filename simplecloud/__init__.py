@@ -2,14 +2,56 @@
 # -*- coding: utf-8 -*-
 
 import docker
+from docker.transport import UnixHTTPAdapter
+from docker.transport.unixconn import UnixHTTPConnectionPool
 import os
+import requests
 import sys
 import logging
 
 
 daemon_url = os.getenv('DOCKER_SOCKET', "unix:///var/run/docker.sock")
-docker_client = docker.DockerClient(base_url=daemon_url)
-docker_api_client = docker.APIClient(base_url=daemon_url)
+daemon_timeout = int(os.getenv('DOCKER_TIMEOUT', 30))
+daemon_pool_size = int(os.getenv('DOCKER_POOL_SIZE', 32))
+
+
+class PooledUnixHTTPAdapter(UnixHTTPAdapter):
+    """Unix socket adapter keeping up to `pool_maxsize` connections alive,
+    so concurrent API calls reuse sockets instead of opening new ones"""
+    def __init__(self, socket_url, timeout=60, pool_connections=25, pool_maxsize=10):
+        self.pool_maxsize = pool_maxsize
+        super(PooledUnixHTTPAdapter, self).__init__(
+            socket_url, timeout, pool_connections=pool_connections
+        )
+
+    def get_connection(self, url, proxies=None):
+        with self.pools.lock:
+            pool = self.pools.get(url)
+            if pool:
+                return pool
+
+            pool = UnixHTTPConnectionPool(
+                url, self.socket_path, self.timeout, maxsize=self.pool_maxsize
+            )
+            self.pools[url] = pool
+
+        return pool
+
+
+docker_client = docker.DockerClient(base_url=daemon_url, timeout=daemon_timeout)
+if daemon_url.startswith('unix://'):
+    docker_client.api._custom_adapter = PooledUnixHTTPAdapter(
+        daemon_url.replace('unix://', 'http+unix://', 1), daemon_timeout,
+        pool_connections=daemon_pool_size, pool_maxsize=daemon_pool_size
+    )
+    docker_client.api.mount('http+docker://', docker_client.api._custom_adapter)
+elif daemon_url.startswith(('tcp://', 'http://')):
+    docker_client.api.mount('http://', requests.adapters.HTTPAdapter(
+        pool_connections=daemon_pool_size, pool_maxsize=daemon_pool_size
+    ))
+
+# share the same connection pool between the high and low level clients
+docker_api_client = docker_client.api
 
 logger = logging.getLogger('simplecloud')
 logger.setLevel(logging.DEBUG)
@@ -19,4 +61,3 @@ handler.setLevel(logging.DEBUG)
 handler.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
 
 logger.addHandler(handler)
-
@@ -16,10 +16,32 @@ Core components:
 from simplecloud import docker_client, docker_api_client, logger
 from simplecloud.network import BridgeNetwork, OpenVSwitchNetwork, OvsException
 from simplecloud.registrator import Registrator
+import docker
+from docker.utils import parse_repository_tag
 import requests
 import base64
-import traceback
-
+import time
+import json
+import os
+import socket
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Lock, Thread
+import weakref
+
+
+# upper bound of concurrent Docker API calls when starting containers
+_MAX_WORKERS = 16
+
+REGISTRY_IMG = "citelab/consul-server:latest"
+REGISTRATOR_IMG = "citelab/registrator:latest"
+PROXY_IMG = "citelab/haproxy:latest"
+
+# restart policy shared by the registry, registrator and proxy containers
+_RESTART_POLICY = {
+    "Name": "on-failure",
+    "MaximumRetryCount": 10
+}
 
 proxy_configs = {
     'mode': ('tcp', 'http'),
@@ -30,27 +52,46 @@ proxy_configs = {
 }
 
 
-def _check_alive_container(container):
-    try:
-        container.reload()
-        return container.status == 'running'
-    except:
-        return False
+# keep-alive connections to the consul HTTP API
+_session = requests.Session()
+_session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
 
+# seconds to wait for consul before giving up on a KV request
+_CONSUL_TIMEOUT = 2
 
 def _stop_container(container):
+    """Remove a container, returns False if the Docker daemon failed to do so"""
     try:
         logger.info(f'Stopping container {container.id}')
         container.remove(force=True)
-    except:
+    except docker.errors.NotFound:
         pass
-    finally:
+    except (docker.errors.APIError, requests.exceptions.RequestException) as e:
+        logger.error(f'Cannot remove container {container.id}: {e}')
+        return False
+    return True
+
+
+def _owner_is_gone(owner):
+    """Tell whether the process recorded as `owner` in a manifest has exited,
+    anything that cannot be checked from this host counts as alive"""
+    if not owner or owner.get('host') != socket.gethostname():
+        return False
+    if owner.get('pid') == os.getpid():
+        # the pid was reused by this very process
         return True
+    try:
+        os.kill(owner['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except (KeyError, TypeError, OSError):
+        return False
+    return False
 
 
 class MyCloudService:
     def __init__(self, image, name, network, port,
-                 init_scale=1, command=None, is_ovs=False):
+                 init_scale=1, command=None, is_ovs=False, cloud=None):
         self.image = image
         self.name = name
         self.port = port
@@ -58,22 +99,47 @@ class MyCloudService:
 
         self.network = network
         self.ovs = is_ovs
+        self._cloud = weakref.ref(cloud) if cloud else None
 
-        self.containers = []
+        # containers and their names keyed by container ID, in start order;
+        # the container objects are only needed to tear them down
+        self.containers = {}
+        self._names = {}
         self.idx = 1
         self.mode = None
         self.balance = None
 
+        # containers status is reused for this many seconds before refreshing
+        self._reload_ttl = 1.0
+        self._last_reload_ts = 0.0
+
         # start the current services with a number of running containers
         self.start(init_scale)
 
     @property
     def size(self):
-        self.reload()
+        if time.monotonic() - self._last_reload_ts > self._reload_ttl:
+            self._refresh()
         return len(self.containers)
 
-    def _create_container(self):
+    def _add_container(self, container):
+        self.containers[container.id] = container
+        self._names[container.id] = container.name
+
+    def _retain(self, is_alive):
+        """Keep only the containers whose ID satisfies `is_alive`"""
+        for cid in [cid for cid in self.containers if not is_alive(cid)]:
+            del self.containers[cid]
+            del self._names[cid]
+
+    def _refresh(self):
+        cloud = self._cloud and self._cloud()
+        if cloud:
+            cloud._refresh_all()
+        else:
+            self.reload()
 
+    def _create_container(self, service_id):
         host_config = docker_api_client.create_host_config(
             auto_remove=True,
             port_bindings={
@@ -81,33 +147,39 @@ class MyCloudService:
             }
         )
 
+        name = f'{service_id}_{self.network.name}'
         pending_container = docker_api_client.create_container(
             image=self.image,
-            name=f'{self.name}_{self.idx:02d}_{self.network.name}',
+            name=name,
             command=self.command,
             detach=True,
             host_config=host_config,
             ports=[self.port],
+            labels={'service': self.name},
             environment={
                 'SERVICE_NAME': self.name,
-                'SERVICE_ID': f'{self.name}_{self.idx:02d}'
+                'SERVICE_ID': service_id
             }
         )
 
-        container = docker_client.containers.get(pending_container)
-        self.idx += 1
+        # skip the inspect call, the model only needs to know its ID and name
+        # until somebody calls reload() on it
+        container = docker_client.containers.prepare_model({
+            'Id': pending_container['Id'],
+            'Name': name
+        })
 
         return container
 
-    def _run_container(self):
-        container = self._create_container()
+    def _run_container(self, service_id):
+        container = self._create_container(service_id)
         # order of operation may affect how registrator works
         if self.network.ovs:
-            container.start()
+            docker_api_client.start(container.id)
             self.network.add_container(container, register=True)
         else:
             self.network.add_container(container)
-            container.start()
+            docker_api_client.start(container.id)
         return container
 
     def info(self):
@@ -117,7 +189,7 @@ class MyCloudService:
             "Port": self.port,
             "Number of containers": self.size,
             "Containers": [
-                {c.id[:12]: c.name} for c in self.containers
+                {cid[:12]: name} for cid, name in self._names.items()
             ],
             "Mode": self.mode or 'tcp',
             "LB algorithm": self.balance or 'roundrobin'
@@ -125,54 +197,83 @@ class MyCloudService:
 
         return _info
 
+    def _run_containers(self, count):
+        """Run a number of new containers concurrently"""
+        if count < 1:
+            return
+        # hand out the names up front so the workers share no counter
+        service_ids = [f'{self.name}_{self.idx + i:02d}' for i in range(count)]
+        self.idx += count
+
+        with ThreadPoolExecutor(max_workers=min(count, _MAX_WORKERS)) as ex:
+            futures = [ex.submit(self._run_container, sid) for sid in service_ids]
+            for future in as_completed(futures):
+                try:
+                    self._add_container(future.result())
+                except Exception as e:
+                    logger.error(e)
+
     def start(self, scale):
         """Start the service with an initial number of containers"""
-        for _ in range(scale):
-            try:
-                container = self._run_container()
-                self.containers.append(container)
-            except Exception as e:
-                logger.error(e)
+        self._run_containers(scale)
 
     def reload(self):
         """Refresh the docker client for up-to-date containers status"""
-        self.containers = list(filter(_check_alive_container, self.containers))
+        cloud = self._cloud and self._cloud()
+        status_cache = cloud._status_cache if cloud else {}
+        # read each status once, the watcher thread drops IDs on destroy
+        statuses = {cid: status_cache.get(cid) for cid in self.containers}
+        if None not in statuses.values():
+            self._retain(lambda cid: statuses[cid] == 'running')
+        else:
+            # one list call for the whole service rather than an inspect per container
+            resp = docker_api_client.containers(
+                filters={'id': list(self.containers), 'status': 'running'})
+            alive = {c['Id'] for c in resp}
+            self._retain(alive.__contains__)
+        self._last_reload_ts = time.monotonic()
 
     def scale(self, new_size):
         """Scale up or down the current service"""
         if new_size < 1:
             return False
-        cur_size = self.size
+        self._refresh()
+        cur_size = len(self.containers)
         if new_size == cur_size:
             return True
         elif new_size < cur_size:
             # stop some running containers
-            for container in self.containers[new_size:]:
-                try:
-                    self.network.remove_container(container.id)
-                    _stop_container(container)
-                except (OvsException,):
-                    pass
+            removed = list(self.containers)[new_size:]
+            self._remove_containers([self.containers.pop(cid) for cid in removed])
+            for cid in removed:
+                del self._names[cid]
             self.reload()
         else:
             # start new containers
-            for _ in range(new_size - cur_size):
-                try:
-                    container = self._run_container()
-                    self.containers.append(container)
-                except Exception as e:
-                    logger.error(e)
+            self._run_containers(new_size - cur_size)
         return True
 
+    def _remove_container(self, container):
+        try:
+            self.network.remove_container(container.id)
+        except (OvsException,):
+            return
+        except docker.errors.APIError as e:
+            logger.warning(f'Cannot disconnect container {container.id[:12]}: {e}')
+        _stop_container(container)
+
+    def _remove_containers(self, containers):
+        """Remove a number of containers concurrently"""
+        if not containers:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(containers), _MAX_WORKERS)) as ex:
+            list(ex.map(self._remove_container, containers))
+
     def stop(self):
         """Stop all containers"""
-        for container in self.containers:
-            try:
-                self.network.remove_container(container.id)
-                _stop_container(container)
-            except (OvsException,):
-                pass
-        self.containers = []
+        self._remove_containers(list(self.containers.values()))
+        self.containers = {}
+        self._names = {}
 
     def __str__(self):
         return f'Service: {self.name}'
@@ -223,13 +324,45 @@ class MyCloud:
         self.proxy_name = "proxy-%s" % network_name
         self.proxy_entrypoint = entrypoint
         self.registry = None
+        self._registry_bridge_ip = None
         self.registrator = None
         self.proxy = None
         self.services = {}
         self.used_ports = set()
+        self._starting = set()
+        self._lock = Lock()
+        self._events = None
+        # container status as last seen on the Docker event stream, keyed by container ID
+        self._status_cache = {}
+        # container events that change the status of a container
+        self._status_events = {
+            'start': 'running',
+            'die': 'exited',
+            'stop': 'exited'
+        }
+        # back-to-back _update() calls within this many seconds are collapsed
+        self._update_min_interval = 0.5
+        self._last_update = 0.0
+        # bumped on every change to the services, invalidates cached infos
+        self._gen = 0
+        self._info_cache = {}
+        # one manifest per network, clouds on other networks keep their own
+        self._manifest_path = os.getenv(
+            'CLOUD_MANIFEST', os.path.expanduser(f'~/.simple-cloud/{self.network.name}.jsonl'))
+        # the manifest of the previous run is only dropped once it has been read
+        self._restored = False
+
+        self._remove_stale_containers()
 
         try:
+            images = {REGISTRY_IMG, PROXY_IMG}
+            if not self.network.ovs:
+                images.add(REGISTRATOR_IMG)
+            images.update(s['image'] for s in initial_services or [])
+            self._prefetch_images(images)
+
             self.create_registry()
+            self.watch_containers()
             self.create_proxy()
 
             self.proxy.start()
@@ -251,26 +384,53 @@ class MyCloud:
                 self.registrator.start()
                 logger.info("Service registrator has been started")
 
+            self.restore_services()
+            # record this run as the owner of the core containers
+            self._save_manifest()
+
             if initial_services:
                 self.initialize_services(initial_services)
 
-        except Exception as e:
-            logger.error(''.join(
-                traceback.format_exception(
-                    type(e), e, e.__traceback__)))
+        except Exception:
+            logger.exception("Cloud init failed")
             self.cleanup()
             raise CloudException
 
+    def _remove_stale_containers(self):
+        """Remove the core containers left behind by a run that crashed, their
+        names would clash with the ones about to be created"""
+        names = {self.registry_name, self.registrator_name, self.proxy_name}
+        resp = docker_api_client.containers(all=True, filters={'name': list(names)})
+        # the name filter matches substrings
+        stale = [c for c in resp if any(name.lstrip('/') in names for name in c['Names'])]
+        if not stale:
+            return
+
+        owner = self._read_manifest_owner()
+        if not _owner_is_gone(owner):
+            raise CloudException(
+                f'Core containers of network {self.network.name} already exist and '
+                f'their owner {owner} may still be running, remove them to continue')
+
+        for c in stale:
+            cid = c['Id']
+            logger.info(f'Removing stale container {cid[:12]}')
+            if self.network.ovs:
+                try:
+                    self.network.remove_container(cid)
+                except OvsException:
+                    logger.warning(f'Cannot remove stale port of container {cid[:12]}')
+            elif cid in self.network.containers:
+                self.network.remove_container(cid)
+            docker_api_client.remove_container(cid, force=True)
+
     def create_registry(self):
         host_config = docker_api_client.create_host_config(
-            restart_policy={
-                "Name": "on-failure",
-                "MaximumRetryCount": 10
-            }
+            restart_policy=_RESTART_POLICY
         )
 
         container = docker_api_client.create_container(
-            image="citelab/consul-server:latest",
+            image=REGISTRY_IMG,
             command=["-bootstrap", f'-advertise={self.registry_ip}'],
             name=self.registry_name,
             host_config=host_config,
@@ -279,19 +439,56 @@ class MyCloud:
 
         self.registry = docker_client.containers.get(container)
 
+    def _prefetch_images(self, images):
+        """Pull the missing images concurrently before any container is created"""
+        def pull(image):
+            repository, tag = parse_repository_tag(image)
+            if not tag:
+                # pulling without a tag would fetch every tag of the repository
+                image = f'{repository}:latest'
+            if docker_client.images.list(name=image):
+                return
+            logger.info(f'Pulling image {image}')
+            docker_client.images.pull(image)
+
+        if not images:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(images), 8)) as ex:
+            list(ex.map(pull, images))
+
+    def watch_containers(self):
+        """Subscribe to container events to keep track of containers status"""
+        self._events = docker_client.events(
+            decode=True,
+            filters={
+                'type': 'container',
+                'event': ['start', 'die', 'stop', 'destroy']
+            }
+        )
+
+        def watcher_loop():
+            for event in self._events:
+                if event['Action'] == 'destroy':
+                    self._status_cache.pop(event['id'], None)
+                else:
+                    self._status_cache[event['id']] = self._status_events[event['Action']]
+                self._gen += 1
+                # the registry may get a new address when it is restarted
+                if self.registry and event['id'] == self.registry.id:
+                    self._registry_bridge_ip = None
+
+        Thread(target=watcher_loop, daemon=True).start()
+
     def create_registrator(self):
         host_config = docker_api_client.create_host_config(
-            restart_policy={
-                "Name": "on-failure",
-                "MaximumRetryCount": 10
-            },
+            restart_policy=_RESTART_POLICY,
             binds=[
                 "/var/run/docker.sock:/tmp/docker.sock"
             ]
         )
 
         container = docker_api_client.create_container(
-            image="citelab/registrator:latest",
+            image=REGISTRATOR_IMG,
             command=["-internal",
                      "-explicit",
                      "-network=%s" % self.network.name,
@@ -318,16 +515,13 @@ class MyCloud:
             proxy_entrypoint = None
 
         host_config = docker_api_client.create_host_config(
-            restart_policy={
-                "Name": "on-failure",
-                "MaximumRetryCount": 10
-            },
+            restart_policy=_RESTART_POLICY,
             binds=proxy_binds,
             privileged=True
         )
 
         container = docker_api_client.create_container(
-            image="citelab/haproxy:latest",
+            image=PROXY_IMG,
             entrypoint=proxy_entrypoint,
             command=[
                 "consul-template",
@@ -345,9 +539,12 @@ class MyCloud:
 
     @property
     def _registry_public_ip(self):
-        self.registry.reload()
+        if self._registry_bridge_ip is None:
+            self.registry.reload()
+            networks = self.registry.attrs['NetworkSettings']['Networks']
+            self._registry_bridge_ip = networks['bridge']['IPAddress']
 
-        return self.registry.attrs['NetworkSettings']['Networks']['bridge']['IPAddress']
+        return self._registry_bridge_ip
 
     def registry_update(self, service, key, value=None, action='put'):
         if service not in self.services:
@@ -361,22 +558,23 @@ class MyCloud:
         else:
             uri = 'http://%s:8500/v1/kv/service/%s/%s' % (self.registry_ip, service, key)
         if action == 'put' and value is not None:
-            resp = requests.put(uri, data=value)
+            resp = _session.put(uri, data=value, timeout=_CONSUL_TIMEOUT)
             if resp.json():    # success
                 setattr(self.services[service], key, value)
+                self._gen += 1
                 return True
             return False
         elif action == 'delete':
-            resp = requests.delete(uri)
+            resp = _session.delete(uri, timeout=_CONSUL_TIMEOUT)
             if resp.json():
                 setattr(self.services[service], key, None)
+                self._gen += 1
                 return True
             return False
         else:
             return False
 
     def registry_get(self, service, key):
-        # TODO
         if service not in self.services:
             return False
         if key not in proxy_configs:
@@ -384,10 +582,10 @@ class MyCloud:
 
         # craft uri from arguments
         if self.network.ovs:
-            pass
+            uri = 'http://%s:8500/v1/kv/service/%s/%s' % (self._registry_public_ip, service, key)
         else:
-            uri = 'http://%s:8500/v1/kv/service/%s/%s'
-        resp = requests.get(uri)
+            uri = 'http://%s:8500/v1/kv/service/%s/%s' % (self.registry_ip, service, key)
+        resp = _session.get(uri, timeout=_CONSUL_TIMEOUT)
 
         # returns default values if key does not exists
         if resp.status_code == 404:
@@ -397,27 +595,63 @@ class MyCloud:
             return base64.b64decode(value)
 
     def start_service(self, image, name, port, scale=1, command=None):
-        if name in self.services:
-            logger.warning(f"Service {name} already exists")
-            return
-        if port in self.used_ports:
-            logger.warning(f"Port {port} has already been used!")
-            return
-        new_service = MyCloudService(
-            image, name, self.network,
-            port, scale, command)
-        self.services[name] = new_service
-        self.used_ports.add(port)
+        with self._lock:
+            if name in self.services or name in self._starting:
+                logger.warning(f"Service {name} already exists")
+                return
+            if port in self.used_ports:
+                logger.warning(f"Port {port} has already been used!")
+                return
+            # hold the name and port while the containers are starting
+            self._starting.add(name)
+            self.used_ports.add(port)
+
+        try:
+            new_service = MyCloudService(
+                image, name, self.network,
+                port, scale, command, cloud=self)
+        except Exception:
+            with self._lock:
+                self.used_ports.discard(port)
+            raise
+        finally:
+            with self._lock:
+                self._starting.discard(name)
+
+        with self._lock:
+            self.services[name] = new_service
+        self._gen += 1
+        self._save_manifest()
 
     def initialize_services(self, services_list):
+        if not services_list:
+            return
+
+        # catch config conflicts before any container gets started
+        seen_names = set()
+        seen_ports = set()
         for service in services_list:
-            self.start_service(**service)
+            if service['name'] in seen_names:
+                raise CloudException(f"Duplicate service name {service['name']}")
+            if service['port'] in seen_ports:
+                raise CloudException(f"Duplicate service port {service['port']}")
+            seen_names.add(service['name'])
+            seen_ports.add(service['port'])
+
+        workers = min(len(services_list), _MAX_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            futures = [ex.submit(self.start_service, **service)
+                       for service in services_list]
+            for future in as_completed(futures):
+                future.result()
 
     def stop_service(self, name):
         old_service = self.services.pop(name, None)
         if old_service:
             old_service.stop()
             self.used_ports.remove(old_service.port)
+            self._gen += 1
+            self._save_manifest()
             logger.info(f"Removed service: {old_service.name}")
             return True
         logger.warning(f"Service {name} does not exist")
@@ -428,38 +662,174 @@ class MyCloud:
 
     def info_service(self, name):
         if name in self.services:
-            return self.services[name].info()
+            gen, info = self._info_cache.get(name, (None, None))
+            if gen != self._gen:
+                gen = self._gen
+                info = self.services[name].info()
+                self._info_cache[name] = (gen, info)
+            return info
         else:
             return {}
 
     def scale_service(self, name, size):
         if name in self.services:
-            return self.services[name].scale(size)
+            result = self.services[name].scale(size)
+            self._gen += 1
+            self._save_manifest()
+            return result
         else:
             return False
 
+    def _save_manifest(self):
+        """Write the running services to the manifest file, one JSON per line"""
+        with self._lock:
+            header = json.dumps({
+                'network': self.network.name,
+                'owner': {'host': socket.gethostname(), 'pid': os.getpid()}
+            }) + '\n'
+            lines = [header] + [json.dumps({
+                'network': self.network.name,
+                'name': service.name,
+                'image': service.image,
+                'port': service.port,
+                'command': service.command,
+                'container_ids': list(service.containers),
+                # bridge addresses are read back from the Docker network, an
+                # ovs bridge has no record of them
+                'addresses': {
+                    cid: self.network.resolve_ip(cid) for cid in service.containers
+                    if cid in self.network.containers
+                } if self.network.ovs else {},
+                'idx': service.idx
+            }) + '\n' for service in self.services.values()]
+
+            try:
+                manifest_dir = os.path.dirname(self._manifest_path) or '.'
+                os.makedirs(manifest_dir, exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=manifest_dir)
+                with os.fdopen(fd, 'w') as f:
+                    f.writelines(lines)
+                os.replace(tmp_path, self._manifest_path)
+            except OSError as e:
+                logger.warning(f'Cannot write manifest {self._manifest_path}: {e}')
+
+    def _read_manifest_owner(self):
+        """Return the process that wrote the manifest, None if nobody did"""
+        try:
+            with open(self._manifest_path, 'r') as f:
+                header = json.loads(f.readline() or '{}')
+        except (OSError, ValueError):
+            return None
+        if header.get('network', self.network.name) != self.network.name:
+            return None
+        return header.get('owner')
+
+    def restore_services(self):
+        """Rebind to services from a previous run whose containers are still running"""
+        if not os.path.isfile(self._manifest_path):
+            self._restored = True
+            return
+
+        with open(self._manifest_path, 'r') as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        # entries written for another network are not ours to adopt
+        entries = [e for e in entries
+                   if 'name' in e and e.get('network', self.network.name) == self.network.name]
+
+        filters = {} if self.network.ovs else {'network': self.network.name}
+        running = {c.id: c for c in docker_client.containers.list(filters=filters)}
+
+        for entry in entries:
+            alive = [running[cid] for cid in entry['container_ids'] if cid in running]
+            if self.network.ovs:
+                # without its address a container cannot be kept off the new pool
+                addresses = entry.get('addresses', {})
+                alive = [c for c in alive if c.id in addresses]
+            if not alive or entry['name'] in self.services or entry['port'] in self.used_ports:
+                continue
+
+            if self.network.ovs:
+                # the fresh address pool and registry know nothing about these
+                self.network._register_existing({c.id: addresses[c.id] for c in alive})
+                for container in alive:
+                    self.network.registrator.register(
+                        container.id, container.attrs, addresses[container.id])
+
+            service = MyCloudService(
+                entry['image'], entry['name'], self.network,
+                entry['port'], 0, entry['command'], cloud=self)
+            for container in alive:
+                service._add_container(container)
+            service.idx = entry['idx']
+
+            self.services[service.name] = service
+            self.used_ports.add(service.port)
+            self._gen += 1
+            logger.info(f"Restored service {service.name} with {len(alive)} containers")
+
+        self._restored = True
+
     def _update(self):
+        now = time.monotonic()
+        if now - self._last_update < self._update_min_interval:
+            return
+        self._last_update = now
+
         self.network.reload()
         for container in (self.registry, self.registrator, self.proxy):
             container.reload()
+        self._refresh_all()
+
+    def _refresh_all(self):
+        """Refresh containers status of all services with a single list call"""
+        # ovs bridges are not docker networks, list every container instead
+        filters = {} if self.network.ovs else {'network': self.network.name}
+        resp = docker_api_client.containers(all=True, filters=filters)
+
+        id_to_status = {c['Id']: c['State'] for c in resp}
+
+        now = time.monotonic()
         for service in self.services.values():
-            service.reload()
+            service._retain(lambda cid: id_to_status.get(cid) == 'running')
+            service._last_reload_ts = now
 
     def cleanup(self):
         logger.debug("Cleaning up everything")
         self.network.stop_listening()
-        for container in (self.registry, self.registrator, self.proxy):
+        if self._events:
+            self._events.close()
+
+        def remove_system_container(container):
+            if container is None:
+                return
             try:
                 self.network.remove_container(container.id)
-                _stop_container(container)
+            except docker.errors.APIError as e:
+                logger.warning(f'Cannot disconnect container {container.id[:12]}: {e}')
             except:
-                continue
-        for service in self.services.values():
-            service.stop()
+                pass
+            _stop_container(container)
+
+        # tear down the core containers and every service at the same time
+        with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as ex:
+            system_removed = ex.map(
+                remove_system_container,
+                (self.registry, self.registrator, self.proxy))
+            services_stopped = ex.map(
+                MyCloudService.stop, self.services.values())
+            list(system_removed)
+            list(services_stopped)
         try:
             self.network.remove()
         except:
             pass
 
+        # keep the manifest if init failed before the services it lists were picked up
+        if self._restored:
+            try:
+                os.remove(self._manifest_path)
+            except OSError:
+                pass
+
         self.running = False
         logger.debug("Removed running services and docker network")
@@ -5,9 +5,158 @@
 from abc import ABC, abstractmethod
 import docker
 import ipaddress
+import orjson
+import re
 from simplecloud import docker_client, docker_api_client, logger
-from sortedcontainers import SortedSet
+import queue
+import socket
+import struct
 import subprocess
+from threading import Lock, Thread
+import time
+
+
+# seconds during which network events are gathered before being handled
+_EVENT_WINDOW = 0.05
+
+
+def _decode_events(stream):
+    """Turn the raw chunks of a Docker event stream into event dicts"""
+    buf = b''
+    for chunk in stream:
+        buf += chunk
+        *lines, buf = buf.split(b'\n')
+        for line in lines:
+            if line:
+                yield orjson.loads(line)
+
+
+def _ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def _int_to_ip(addr):
+    return socket.inet_ntoa(struct.pack('!I', addr))
+
+
+# first byte of the bitmap with at least one free address in it
+_NONZERO_BYTE = re.compile(rb'[^\x00]')
+
+
+class AddressPool:
+    """Free host addresses of a subnet, as integers, lending the lowest one first.
+
+    The pool is a bitmap with one bit per host address, set when the address
+    is free, so a /16 subnet takes 8 KiB instead of one object per host."""
+    def __init__(self, subnet):
+        if subnet.num_addresses > 2:
+            # skip the network and broadcast addresses
+            self._base = int(subnet.network_address) + 1
+            self._n = subnet.num_addresses - 2
+        else:
+            self._base = int(subnet.network_address)
+            self._n = subnet.num_addresses
+
+        # containers may be added from several threads at once
+        self._lock = Lock()
+
+        if self._n <= 256:
+            # a /24 or smaller fits in one int, whose bit tricks beat the byte scan
+            self._bits = (1 << self._n) - 1
+            self.pop = self._pop_small
+            self.remove = self._remove_small
+            self.remove_many = self._remove_many_small
+            self.add = self._add_small
+            return
+
+        self._free = bytearray(b'\xff' * ((self._n + 7) // 8))
+        if self._n % 8:
+            self._free[-1] = (1 << (self._n % 8)) - 1
+        # no byte before this one has a free address
+        self._hint = 0
+
+    def _index(self, addr):
+        idx = addr - self._base
+        return idx if 0 <= idx < self._n else None
+
+    def pop(self):
+        """Take the lowest free address, returns None if the pool is empty"""
+        with self._lock:
+            match = _NONZERO_BYTE.search(self._free, self._hint)
+            if match is None:
+                self._hint = len(self._free)
+                return None
+            i = match.start()
+            byte = self._free[i]
+            low = byte & -byte
+            self._free[i] = byte ^ low
+            self._hint = i
+            return self._base + (i << 3) + low.bit_length() - 1
+
+    def remove(self, addr):
+        """Take a specific address, returns False if it was already in use"""
+        idx = self._index(addr)
+        if idx is None:
+            return False
+        mask = 1 << (idx & 7)
+        with self._lock:
+            if not self._free[idx >> 3] & mask:
+                return False
+            self._free[idx >> 3] &= ~mask
+            return True
+
+    def remove_many(self, addrs):
+        """Take several specific addresses at once, under a single lock"""
+        free = self._free
+        with self._lock:
+            for addr in addrs:
+                idx = self._index(addr)
+                if idx is not None:
+                    free[idx >> 3] &= ~(1 << (idx & 7))
+
+    def add(self, addr):
+        """Give an address back to the pool"""
+        idx = self._index(addr)
+        if idx is None:
+            return
+        with self._lock:
+            self._free[idx >> 3] |= 1 << (idx & 7)
+            self._hint = min(self._hint, idx >> 3)
+
+    def _pop_small(self):
+        with self._lock:
+            low = self._bits & -self._bits
+            if not low:
+                return None
+            self._bits ^= low
+            return self._base + low.bit_length() - 1
+
+    def _remove_small(self, addr):
+        idx = self._index(addr)
+        if idx is None:
+            return False
+        mask = 1 << idx
+        with self._lock:
+            if not self._bits & mask:
+                return False
+            self._bits ^= mask
+            return True
+
+    def _remove_many_small(self, addrs):
+        mask = 0
+        for addr in addrs:
+            idx = self._index(addr)
+            if idx is not None:
+                mask |= 1 << idx
+        with self._lock:
+            self._bits &= ~mask
+
+    def _add_small(self, addr):
+        idx = self._index(addr)
+        if idx is None:
+            return
+        with self._lock:
+            self._bits |= 1 << idx
 
 
 class BaseNetwork(ABC):
@@ -53,9 +202,12 @@ class BridgeNetwork(BaseNetwork):
         self._network = None
         self.ovs = False
         self.subnet = ipaddress.ip_network(subnet)
-        self.address_pool = SortedSet(self.subnet.hosts())
+        self._subnet_first = int(self.subnet.network_address)
+        self._subnet_last = int(self.subnet.broadcast_address)
+        self.address_pool = AddressPool(self.subnet)
         self.containers = dict()
         self.listening = False
+        self._events = None
 
         self.reservations = reserved_ips
 
@@ -64,8 +216,8 @@ class BridgeNetwork(BaseNetwork):
         self.name = self._network.name
 
         self._handlers = {
-            ('network', 'connect'): self.handler_network_connect,
-            ('network', 'disconnect'): self.handler_network_disconnect
+            'network:connect': self.handler_network_connect,
+            'network:disconnect': self.handler_network_disconnect
         }
 
     def attach_to_existing_network(self, name):
@@ -78,15 +230,18 @@ class BridgeNetwork(BaseNetwork):
 
             network_gateway = self._network.attrs['IPAM']['Config'][0].get('Gateway')
 
+            # these are connected already, only the local state needs filling
+            self._register_existing({
+                cid: specs['IPv4Address'].partition('/')[0]
+                for cid, specs in self._network.attrs['Containers'].items()
+            })
+
             if network_gateway:
                 self._remove_ip(network_gateway)
             else:
+                # lend it only once the addresses in use are out of the pool
                 self.reservations['_'] = self._get_next_address()
 
-            for cid, specs in self._network.attrs['Containers'].items():
-                addr = specs['IPv4Address'][:-3]
-                self.add_container(cid, addr)
-
             return True
         else:
             return False
@@ -109,17 +264,16 @@ class BridgeNetwork(BaseNetwork):
         )
 
         # reserve one IP for the default gateway
-        for ip in self.reservations.values():
-            self._remove_ip(ip)
+        self._remove_ips(self.reservations.values())
         self.reservations['_'] = self._get_next_address()
 
     def _get_next_address(self):
-        if self.address_pool:
-            next_addr = self.address_pool[0]
-            self.address_pool.pop(0)
+        next_addr = self.address_pool.pop()
 
-            logger.debug(f'Lending IP address {str(next_addr)}')
-            return str(next_addr)
+        if next_addr is not None:
+            next_addr = _int_to_ip(next_addr)
+            logger.debug('Lending IP address %s', next_addr)
+            return next_addr
         else:
             logger.debug('No available IP address in the address pool')
             return None
@@ -136,80 +290,113 @@ class BridgeNetwork(BaseNetwork):
         return str(ip)
 
     def _remove_ip(self, ip):
-        addr = ipaddress.ip_address(ip)
+        addr = _ip_to_int(ip)
 
-        if addr not in self.subnet:
+        if not self._subnet_first <= addr <= self._subnet_last:
             raise ValueError
 
-        try:
-            self.address_pool.remove(addr)
-            logger.debug(f'Address {ip} is now in use')
-            return addr
-        except KeyError:
-            return None
+        if self.address_pool.remove(addr):
+            logger.debug('Address %s is now in use', ip)
+            return ip
+        return None
+
+    def _remove_ips(self, ips):
+        addrs = [_ip_to_int(ip) for ip in ips if ip]
+
+        if any(not self._subnet_first <= addr <= self._subnet_last for addr in addrs):
+            raise ValueError
+
+        self.address_pool.remove_many(addrs)
+        logger.debug('%s reserved addresses are now in use', len(addrs))
 
     def _add_ip(self, ip):
-        addr = ipaddress.ip_address(ip)
-        self.address_pool.add(addr)
-        logger.debug(f'Address {ip} is now available in the address pool')
-        return addr
+        self.address_pool.add(_ip_to_int(ip))
+        logger.debug('Address %s is now available in the address pool', ip)
+        return ip
+
+    def _register_existing(self, ips):
+        addrs = {cid: _ip_to_int(ip) for cid, ip in ips.items()}
+
+        if any(not self._subnet_first <= addr <= self._subnet_last for addr in addrs.values()):
+            raise ValueError
+
+        self.address_pool.remove_many(addrs.values())
+        first = self._subnet_first
+        self.containers.update((cid, addr - first) for cid, addr in addrs.items())
 
     def add_container(self, container, addr=None, reservation=None, register=None):
         reserved_ip = self.reservations.get(reservation)
 
         if reserved_ip:
-            ipaddr = ipaddress.ip_address(reserved_ip)
+            ipaddr = reserved_ip
         elif addr:
             ipaddr = self._remove_ip(addr)
         else:
             ipaddr = self._get_next_address()
 
-        logger.debug(f'Connect container {container.id[:12]} to network')
+        logger.debug('Connect container %s to network', container.id[:12])
 
         # docker network connect
         docker_api_client.connect_container_to_network(
-            container.id, self._network.id, ipv4_address=str(ipaddr)
+            container.id, self._network.id, ipv4_address=ipaddr
         )
 
-        self.containers[container.id] = ipaddr
+        # keep the offset in the subnet, a small int is cheaper than a str
+        self.containers[container.id] = (
+            _ip_to_int(ipaddr) - self._subnet_first if ipaddr else None
+        )
 
     def remove_container(self, cid):
-        logger.debug(f'Disconnect container {cid[:12]} from network')
+        # never connected by us, nothing to disconnect
+        if cid not in self.containers:
+            return
+
+        logger.debug('Disconnect container %s from network', cid[:12])
 
         try:
             docker_api_client.disconnect_container_from_network(
                 cid, self._network.id, force=True
             )
-        except docker.errors.APIError:
+        except docker.errors.NotFound:
+            # the container is gone, and so is its endpoint
             pass
 
-        ipaddr = self.containers.pop(cid, None)
-        if ipaddr:
-            self._add_ip(ipaddr)
+        self._release(cid)
+
+    def _release(self, cid):
+        offset = self.containers.pop(cid, None)
+        if offset is None:
+            return
+        ip = _int_to_ip(self._subnet_first + offset)
+        # a reserved address stays out of the pool, its owner may come back
+        if ip not in self.reservations.values():
+            self._add_ip(ip)
 
     def handler_network_connect(self, event):
-        if event['Actor']['ID'] == self._network.id:
-            cid = event['Actor']['Attributes']['container']
+        cid = event['Actor']['Attributes']['container']
 
-            if cid in self.containers:
-                return
+        if cid in self.containers:
+            return
 
-            container = docker_client.containers.get(cid)
-            networks = container.attrs['NetworkSettings']['Networks']
-            ipaddr = networks[self._network.name]['IPAddress']
+        # newer daemons may send the address along with the event
+        ipaddr = event['Actor']['Attributes'].get('IPv4Address', '').partition('/')[0]
+        if not ipaddr:
+            attrs = docker_api_client.inspect_container(cid)
+            ipaddr = attrs['NetworkSettings']['Networks'][self._network.name]['IPAddress']
+        container = docker_client.containers.prepare_model({'Id': cid})
 
-            logger.info(f'Network connect event with container {cid[:12]}')
-            self.add_container(container, ipaddr)
+        logger.info('Network connect event with container %s', cid[:12])
+        self.add_container(container, ipaddr)
 
     def handler_network_disconnect(self, event):
-        if event['Actor']['ID'] == self._network.id:
-            cid = event['Actor']['Attributes']['container']
+        cid = event['Actor']['Attributes']['container']
 
-            if cid not in self.containers:
-                return
+        if cid not in self.containers:
+            return
 
-            logger.info(f'Network disconnect event with container {cid[:12]}')
-            self.remove_container(cid)
+        logger.info('Network disconnect event with container %s', cid[:12])
+        # already disconnected, only the address needs to be given back
+        self._release(cid)
 
     def listen(self):
         logger.info('Listening to Docker events...')
@@ -218,12 +405,72 @@ class BridgeNetwork(BaseNetwork):
 
         self._network.reload()
 
-        for event in docker_client.events(decode=True):
-            if not self.listening:
+        # let the daemon drop the events of other networks
+        self._events = docker_client.events(
+            decode=False,
+            filters={
+                'type': 'network',
+                'event': ['connect', 'disconnect'],
+                'network': self._network.id
+            }
+        )
+
+        # read events on a separate thread so they pile up while a batch is handled
+        pending = queue.Queue()
+
+        def reader_loop():
+            try:
+                for event in _decode_events(self._events):
+                    pending.put(event)
+            finally:
+                # wake listen() up even if the stream broke
+                pending.put(None)
+
+        Thread(target=reader_loop, daemon=True).start()
+
+        done = False
+        while self.listening and not done:
+            event = pending.get()
+            if event is None:
                 break
-            func = self._handlers.get((event['Type'], event['Action']))
-            if func:
-                func(event)
+            batch = [event]
+            deadline = time.monotonic() + _EVENT_WINDOW
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    event = pending.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if event is None:
+                    done = True
+                    break
+                batch.append(event)
+
+            for event in self._coalesce(batch):
+                if not self.listening:
+                    break
+                func = self._handlers.get(f"{event['Type']}:{event['Action']}")
+                if func:
+                    func(event)
+
+    @staticmethod
+    def _coalesce(events):
+        """Reduce a batch of events to the ones that change the network state,
+        keeping the first and last event seen for every container"""
+        per_container = {}
+        for event in events:
+            cid = event['Actor']['Attributes']['container']
+            first, _ = per_container.get(cid, (event, None))
+            per_container[cid] = (first, event)
+
+        for first, last in per_container.values():
+            if first['Action'] == 'disconnect' and last['Action'] == 'connect':
+                yield first
+            # a container connected then disconnected again may still be
+            # tracked by add_container(), its address has to be given back
+            yield last
 
     def reload(self):
         self._network.reload()
@@ -233,9 +480,11 @@ class BridgeNetwork(BaseNetwork):
 
     def stop_listening(self):
         self.listening = False
+        if self._events:
+            self._events.close()
 
     def resolve_ip(self, cid):
-        return str(self.containers[cid])
+        return _int_to_ip(self._subnet_first + self.containers[cid])
 
 
 class OvsException(Exception):
@@ -247,17 +496,19 @@ class OpenVSwitchNetwork(BaseNetwork):
         self.name = network_name
         self.ovs = True
         self.subnet = ipaddress.ip_network(subnet)
-        self.address_pool = SortedSet(self.subnet.hosts())
+        self._subnet_first = int(self.subnet.network_address)
+        self._subnet_last = int(self.subnet.broadcast_address)
+        self.address_pool = AddressPool(self.subnet)
         self.containers = dict()
         self.registrator = None
         self.listening = False
+        self._events = None
 
         self.reservations = reserved_ips
 
         # reserve 1 IP address for the default gateway
         self.reservations['_'] = self._get_next_address()
-        for _, ip in self.reservations.items():
-            self._remove_ip(ip)
+        self._remove_ips(self.reservations.values())
 
         if not self.check_bridge_exists():
             self.create_network(network_name)
@@ -265,8 +516,8 @@ class OpenVSwitchNetwork(BaseNetwork):
             logger.debug('Bridge already exists, using it instead')
 
         self._handlers = {
-            ('container', 'die'): self.handler_container_die,
-            ('container', 'start'): self.handler_container_start
+            'container:die': self.handler_container_die,
+            'container:start': self.handler_container_start
         }
 
     def check_bridge_exists(self):
@@ -293,14 +544,14 @@ class OpenVSwitchNetwork(BaseNetwork):
             raise OvsException(err.decode())
 
     def _get_next_address(self):
-        if self.address_pool:
-            next_addr = self.address_pool[0]
-            self.address_pool.pop(0)
+        next_addr = self.address_pool.pop()
 
-            logger.debug(f'Lending IP address {str(next_addr)}')
-            return str(next_addr)
+        if next_addr is not None:
+            next_addr = _int_to_ip(next_addr)
+            logger.debug('Lending IP address %s', next_addr)
+            return next_addr
         else:
-            logger.debug(f'No available IP address in the address pool')
+            logger.debug('No available IP address in the address pool')
             return None
 
     def get_available_ip(self):
@@ -315,42 +566,54 @@ class OpenVSwitchNetwork(BaseNetwork):
         return str(ip)
 
     def _remove_ip(self, ip):
-        addr = ipaddress.ip_address(ip)
+        addr = _ip_to_int(ip)
 
-        if addr not in self.subnet:
+        if not self._subnet_first <= addr <= self._subnet_last:
             raise ValueError
 
-        try:
-            self.address_pool.remove(addr)
-            logger.debug(f'Address {ip} is now in use')
-            return addr
-        except KeyError:
-            return None
+        if self.address_pool.remove(addr):
+            logger.debug('Address %s is now in use', ip)
+            return ip
+        return None
+
+    def _remove_ips(self, ips):
+        addrs = [_ip_to_int(ip) for ip in ips if ip]
+
+        if any(not self._subnet_first <= addr <= self._subnet_last for addr in addrs):
+            raise ValueError
+
+        self.address_pool.remove_many(addrs)
+        logger.debug('%s reserved addresses are now in use', len(addrs))
 
     def _add_ip(self, ip):
-        addr = ipaddress.ip_address(ip)
-        self.address_pool.add(addr)
-        logger.debug(f'Address {ip} is now available in the address pool')
-        return addr
+        self.address_pool.add(_ip_to_int(ip))
+        logger.debug('Address %s is now available in the address pool', ip)
+        return ip
+
+    def _register_existing(self, ips):
+        self._remove_ips(ips.values())
+        self.containers.update(ips)
 
     def add_container(self, container, addr=None, reservation=None, register=False):
         reserved_ip = self.reservations.get(reservation)
 
         if reserved_ip:
-            ipaddr = ipaddress.ip_address(reserved_ip)
+            ipaddr = reserved_ip
         elif addr:
             ipaddr = self._remove_ip(addr)
         else:
             ipaddr = self._get_next_address()
 
-        logger.debug(f'Connect container {container.id[:12]} to network')
+        logger.debug('Connect container %s to network', container.id[:12])
 
         if register:
-            self.registrator.register(container, str(ipaddr))
+            # the model may only know its ID, read the config straight from the daemon
+            attrs = docker_api_client.inspect_container(container.id)
+            self.registrator.register(container.id, attrs, ipaddr)
 
         # connect to ovs bridge
         command = f'ovs-docker add-port {self.name} eth1 {container.id[:12]} '
-        command += f'--ipaddress={str(ipaddr)}/{self.subnet.prefixlen}'
+        command += f'--ipaddress={ipaddr}/{self.subnet.prefixlen}'
         run = subprocess.Popen(command, shell=True,
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
@@ -367,7 +630,7 @@ class OpenVSwitchNetwork(BaseNetwork):
             self.containers[container.id] = ipaddr
 
     def remove_container(self, cid):
-        logger.debug(f'Disconnect container {cid[:12]} from network')
+        logger.debug('Disconnect container %s from network', cid[:12])
 
         if self.listening:
             self.registrator.deregister(cid)
@@ -397,16 +660,24 @@ class OpenVSwitchNetwork(BaseNetwork):
         if cid not in self.containers:
             return
 
-        logger.info(f'Network disconnect event with container {cid[:12]}')
+        logger.info('Network disconnect event with container %s', cid[:12])
         self.remove_container(cid)
 
     def listen(self):
         logger.info('Listening to Docker events...')
 
-        for event in docker_client.events(decode=True):
+        self._events = docker_client.events(
+            decode=False,
+            filters={
+                'type': 'container',
+                'event': ['die', 'start']
+            }
+        )
+
+        for event in _decode_events(self._events):
             if not self.listening:
                 break
-            func = self._handlers.get((event['Type'], event['Action']))
+            func = self._handlers.get(f"{event['Type']}:{event['Action']}")
             if func:
                 func(event)
 
@@ -422,6 +693,8 @@ class OpenVSwitchNetwork(BaseNetwork):
 
     def stop_listening(self):
         self.listening = False
+        if self._events:
+            self._events.close()
 
     def resolve_ip(self, cid):
         return str(self.containers[cid])
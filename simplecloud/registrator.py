@@ -10,33 +10,30 @@ class Registrator:
         consul_container.reload()
         consul_ip = consul_container.attrs['NetworkSettings']['Networks']['bridge']['IPAddress']
 
-        logger.debug(f'Connecting to Consul at address {consul_ip}')
+        logger.debug('Connecting to Consul at address %s', consul_ip)
         self.consul = consul.Consul(host=consul_ip)
 
-    def register(self, container, ip):
-        container.reload()
-
-        config = container.attrs['Config']
-        env_vars = config['Env']
-        ports = list(config['ExposedPorts'].keys())
-        port = int(ports[0].split('/')[0])
+    def register(self, container_id, attrs, ip):
+        config = attrs['Config']
+        port_str = next(iter(config['ExposedPorts']))
+        port = int(port_str[:port_str.index('/')])
 
         service = dict()
-        for var in env_vars:
-            key, val = var.split('=')
-            if key.startswith('SERVICE'):
-                _, attr = key.lower().split('_')
-                service[attr] = val
+        for var in config['Env']:
+            if not var.startswith('SERVICE_'):
+                continue
+            key, _, val = var.partition('=')
+            service[key[8:].lower()] = val
 
         if 'name' in service:
-            logger.debug(f'Registering container {container.id} with {ip}')
+            logger.debug('Registering container %s with %s', container_id, ip)
             self.consul.agent.service.register(
                 service['name'],
-                service_id=container.id,
+                service_id=container_id,
                 port=port,
                 address=ip
             )
 
     def deregister(self, cid):
-        logger.debug(f'De-registering container {cid}')
+        logger.debug('De-registering container %s', cid)
         self.consul.agent.service.deregister(cid)